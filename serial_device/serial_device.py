@@ -3,10 +3,28 @@ SerialDevice class for connecting and communicating with a serial device
 """
 import serial
 import asyncio
+import glob
+import os
+import selectors
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import serial.tools.list_ports as list_ports
 from curses.ascii import EOT
 import readline  # NOQA
 
+LINUX_PORT_PATTERNS = (
+    '/dev/ttyS*',      # built-in serial ports
+    '/dev/ttyUSB*',    # usb-serial with own driver
+    '/dev/ttyXRUSB*',  # xr-usb-serial port exar
+    '/dev/ttyACM*',    # usb-serial with CDC-ACM profile
+    '/dev/ttyAMA*',    # ARM internal port (raspi)
+    '/dev/rfcomm*',    # BT serial devices
+    '/dev/ttyAP*',     # Advantech multi-port serial controllers
+    '/dev/ttyGS*',     # gadget serial devices
+)
+
 
 class SerialDevice:
 
@@ -16,78 +34,266 @@ class SerialDevice:
         self.baudrate = baudrate
         self.trans_end = trans_end
         self.encoding = 'utf-8'
+        self._trans_end_bytes = trans_end.encode(self.encoding)
         self.timeout = 2
+        self._inter_byte_timeout = None
+        self.chunk_size = 1024
+        self.open_settle = 0
+        self.buffer_size = 65536
         self.open_delay = 2
         self.close_delay = 1
         self.devices = {}
+        self._rx_pending = {}
+        self._ports_cache = None
+        self._ports_cache_ts = 0.0
+        self._ports_cache_ttl = 1.0
+        self._scan_lock = threading.Lock()
+        self._scan_stop = threading.Event()
+        self._scan_pool = None
+        self._loop = None
+
+    def __del__(self):
+        # Nothing may be run on the loop anymore while being collected
+        loop = getattr(self, '_loop', None)
+        if loop is not None and not loop.is_closed():
+            loop.close()
+
+    @property
+    def inter_byte_timeout(self):
+        """
+        Gap (in seconds) after which a partial reply is considered complete,
+        for devices with an unreliable transaction end. None disables it.
+        """
+        return self._inter_byte_timeout
+
+    @inter_byte_timeout.setter
+    def inter_byte_timeout(self, value):
+        # The driver has to end reads at a gap too, so apply it to the
+        # devices that are already known
+        self._inter_byte_timeout = value
+        for entry in self.devices.values():
+            entry['device'].inter_byte_timeout = value
+
+    def _enum_ports(self):
+        """
+        Enumerates the names of all available serial ports.
+        On Windows the SERIALCOMM registry key is read directly, which
+        avoids the (slow) full PnP device enumeration of comports().
+        On Linux and macOS the device nodes are globbed, which avoids the
+        sysfs/IOKit walk comports() does to collect port details.
+        """
+        if sys.platform.startswith('linux'):
+            # Same patterns (and platform filter) as list_ports_linux
+            ports = []
+            for pattern in LINUX_PORT_PATTERNS:
+                ports.extend(glob.glob(pattern))
+            return [port for port in ports if not self._is_platform_tty(port)]
+        if sys.platform == 'darwin':
+            return glob.glob('/dev/cu.*')
+        if sys.platform == 'win32':
+            try:
+                import winreg
+                with winreg.OpenKey(
+                    winreg.HKEY_LOCAL_MACHINE,
+                    r'HARDWARE\DEVICEMAP\SERIALCOMM'
+                ) as key:
+                    ports = []
+                    nr_values = winreg.QueryInfoKey(key)[1]
+                    for i in range(nr_values):
+                        ports.append(winreg.EnumValue(key, i)[1])
+                    return ports
+            except OSError:
+                pass
+        return [i.device for i in list_ports.comports()]
+
+    @staticmethod
+    def _is_platform_tty(port):
+        """
+        Returns True for ttys of the platform subsystem (e.g. the fixed
+        legacy /dev/ttyS* ports), which comports() skips as well.
+        """
+        device_path = os.path.join(
+            '/sys/class/tty', os.path.basename(port), 'device'
+        )
+        if not os.path.exists(device_path):
+            return False
+        subsystem = os.path.realpath(os.path.join(device_path, 'subsystem'))
+        return os.path.basename(subsystem) == 'platform'
 
     def _get_ports(self):
         """
         Returns a list of all available serial ports.
         The list is in reversed order because newly connected
         serial devices are usually located at the end of the list.
+        The result is cached for self._ports_cache_ttl seconds.
         """
-        ports = sorted(
-            [i.device for i in list(list_ports.comports())],
-            reverse=True
-        )
-        return ports
+        now = time.monotonic()
+        if (self._ports_cache is None
+                or now - self._ports_cache_ts >= self._ports_cache_ttl):
+            self._ports_cache = sorted(self._enum_ports(), reverse=True)
+            self._ports_cache_ts = now
+        return list(self._ports_cache)
 
     def _resolv_device(self, device):
         """Device resolver, returns the actual device object"""
-        if device.__class__.__name__ == "Serial":
+        if isinstance(device, serial.SerialBase):
             return device
-        elif device in self.devices:
-            return self.devices[device]['device']
-        else:
-            return None
+        elif isinstance(device, str):
+            entry = self.devices.get(device)
+            if entry is not None:
+                return entry['device']
+        return None
 
-    async def _scan_port(self, port):
+    def _open_port(self, port):
         """
-        Tries to find a possibly connected serial device at the specified port.
-        If a serial device is found it is added to the devices dictionary.
-
-        Returns a boolean indicating if a serial device was found at the
-        specified port.
+        (Synchronously) opens the specified port for probing.
+        Returns the opened device, or None if the port could not be opened.
         """
-        success = False
         try:
             device = serial.Serial(
                 port=port,
                 baudrate=self.baudrate,
                 write_timeout=self.timeout,
-                timeout=self.timeout
+                timeout=self.timeout,
+                inter_byte_timeout=self.inter_byte_timeout
             )
         except serial.serialutil.SerialException:
-            pass
+            return None
+        self._set_buffer_size(device)
+        return device
+
+    def _set_buffer_size(self, device):
+        """
+        Sets the driver buffer sizes of an opened device. Only available
+        (and needed) on Windows, where every open resets them to 4 KiB.
+        """
+        if hasattr(device, 'set_buffer_size'):
+            device.set_buffer_size(
+                rx_size=self.buffer_size,
+                tx_size=self.buffer_size
+            )
+
+    def _close_port(self, device):
+        """Closes a device and discards any bytes still pending for it"""
+        device.close()
+        self._rx_pending.pop(device, None)
+
+    def _probe_port(self, port, device):
+        """
+        (Synchronously) asks the device opened at the specified port for its
+        id. If it is a valid serial device it is added to the devices
+        dictionary and left open, otherwise the port is closed again.
+
+        Returns a boolean indicating if a serial device was found.
+        """
+        success = False
+        if self.open_settle > 0:
+            time.sleep(self.open_settle)
+        try:
+            self.send(device, 'id')
+        except serial.serialutil.SerialTimeoutException:
+            self._close_port(device)
         else:
-            await asyncio.sleep(self.timeout)
-            try:
-                self.send(device, 'id')
-            except serial.serialutil.SerialTimeoutException:
-                device.close()
-            else:
-                reply = (
-                    self.recv(device)
-                ).strip(self.trans_end)
-                if reply.startswith(self.id_prefix):
-                    if reply not in self.devices:
+            reply = (
+                self.recv(device)
+            ).strip(self.trans_end)
+            keep_open = False
+            if reply.startswith(self.id_prefix):
+                with self._scan_lock:
+                    if (not self._scan_stop.is_set()
+                            and reply not in self.devices):
                         self.devices[reply] = {
                             'port': port,
                             'device': device,
                         }
-                    success = True
-                device.close()
+                        keep_open = True
+                success = True
+            if not keep_open:
+                self._close_port(device)
         return success
 
+    def _scan_port_sync(self, port):
+        """
+        (Synchronously) tries to find a possibly connected serial device at
+        the specified port: opens it and probes it immediately.
+
+        Returns a boolean indicating if a serial device was found at the
+        specified port.
+        """
+        device = self._open_port(port)
+        if device is None:
+            return False
+        return self._probe_port(port, device)
+
+    def _reset_devices(self):
+        """
+        Closes all known devices and clears the devices dictionary.
+        Waits for probes left running by a previous _scan_first first, so
+        they cannot register devices or share a port with the new scan.
+        """
+        if self._scan_pool is not None:
+            self._scan_pool.shutdown(wait=True)
+            self._scan_pool = None
+        for entry in self.devices.values():
+            self._close_port(entry['device'])
+        self.devices = {}
+        self._scan_stop.clear()
+
     async def _scan(self):
         """
-        Scans for all connected serial devices and rebuilds self.devices
+        Scans for all connected serial devices and rebuilds self.devices.
+        The ports are probed in parallel, each in its own worker thread.
         Returns a list of device names found
         """
-        self.devices = {}
-        tasks = [self._scan_port(port) for port in self._get_ports()]
-        await asyncio.gather(*tasks)
+        self._reset_devices()
+        ports = self._get_ports()
+        if ports:
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(max_workers=min(32, len(ports))) as pool:
+                tasks = [
+                    loop.run_in_executor(pool, self._scan_port_sync, port)
+                    for port in ports
+                ]
+                await asyncio.gather(*tasks)
+        return [key for key in self.devices.keys()]
+
+    async def _scan_first(self, expected_id=None):
+        """
+        Scans for connected serial devices like _scan, but stops as soon as
+        a device is identified (or, if specified, the device expected_id).
+        Probes that are still running are discarded.
+        Returns a list of device names found
+        """
+        self._reset_devices()
+        ports = self._get_ports()
+        if ports:
+            loop = asyncio.get_running_loop()
+            pool = ThreadPoolExecutor(max_workers=min(32, len(ports)))
+            pending = {
+                loop.run_in_executor(pool, self._scan_port_sync, port)
+                for port in ports
+            }
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        # Raises probe exceptions, like gather in _scan
+                        task.result()
+                    if expected_id is None:
+                        if self.devices:
+                            break
+                    elif expected_id in self.devices:
+                        break
+            finally:
+                with self._scan_lock:
+                    self._scan_stop.set()
+                for task in pending:
+                    task.cancel()
+                pool.shutdown(wait=False)
+                self._scan_pool = pool
         return [key for key in self.devices.keys()]
 
     async def _open(self, device):
@@ -98,7 +304,10 @@ class SerialDevice:
         success = False
         open_device = self._resolv_device(device)
         if open_device is not None:
+            if open_device.is_open:
+                return True
             open_device.open()
+            self._set_buffer_size(open_device)
             await asyncio.sleep(self.open_delay)
             success = open_device.is_open
         return success
@@ -111,30 +320,76 @@ class SerialDevice:
         success = True
         close_device = self._resolv_device(device)
         if close_device is not None:
-            close_device.close()
+            self._close_port(close_device)
             await asyncio.sleep(self.close_delay)
             success = not close_device.is_open
         return success
 
-    def scan(self):
+    async def _cmd_all(self, cmd, limit=8):
+        """
+        (Asynchronously) sends cmd to all open devices in parallel, running
+        at most limit transactions at the same time.
+        Returns a dictionary with the reply of each device.
+        """
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(limit)
+
+        async def one(id):
+            async with sem:
+                reply = await loop.run_in_executor(None, self.cmd, id, cmd)
+                return id, reply
+
+        ids = [
+            key for key, entry in self.devices.items()
+            if entry['device'].is_open
+        ]
+        return dict(await asyncio.gather(*[one(id) for id in ids]))
+
+    def _run(self, coro):
+        """
+        Runs a coroutine to completion on the event loop of this instance.
+        The loop is created on first use and reused by later calls.
+        """
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    def shutdown(self):
+        """Shuts down and closes the event loop of this instance (if any)"""
+        loop = getattr(self, '_loop', None)
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                # Not available before Python 3.9
+                if hasattr(loop, 'shutdown_default_executor'):
+                    loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                loop.close()
+        self._loop = None
+
+    def scan(self, first=False, expected_id=None):
         """
-        Synchronizes the asynchronous scan and returns the result
+        Synchronizes the asynchronous scan and returns the result.
+        With first=True the scan stops at the first identified device
+        (or at expected_id, if specified).
         """
-        return asyncio.run(self._scan())
+        if first:
+            return self._run(self._scan_first(expected_id))
+        return self._run(self._scan())
 
     def open(self, device):
         """
         (Synchronously) opens a device (if existing and not already opened).
         Returns a boolean indicating if the indicated device is open.
         """
-        return asyncio.run(self._open(device))
+        return self._run(self._open(device))
 
     def close(self, device):
         """
         (Synchronoulsy) closes a device (if existing and opened).
         Returns a boolean indicating if the indicated device is NOT open.
         """
-        return asyncio.run(self._close(device))
+        return self._run(self._close(device))
 
     def is_open(self, device):
         """Returns is_open attribute of a specific device"""
@@ -149,30 +404,236 @@ class SerialDevice:
         if flush_device is not None:
             if flush_device.is_open:
                 flush_device.reset_input_buffer()
+                self._rx_pending.pop(flush_device, None)
                 flush_device.reset_output_buffer()
 
+    def _send(self, sender, data):
+        """Writes data to an already resolved and opened device"""
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode(self.encoding)
+        sender.write(data + self._trans_end_bytes)
+
     def send(self, device, data):
-        """Implementation of the send functionality"""
+        """
+        Implementation of the send functionality.
+        data can be either a str (which is encoded) or bytes.
+        """
         sender = self._resolv_device(device)
         if sender is not None:
             if sender.is_open:
-                sender.write((data + self.trans_end).encode(self.encoding))
+                self._send(sender, data)
+
+    def send_many(self, device, items):
+        """
+        Sends multiple items (str or bytes), each followed by the
+        transaction end, using a single write.
+        """
+        sender = self._resolv_device(device)
+        if sender is not None:
+            if sender.is_open:
+                buf = bytearray()
+                for data in items:
+                    if not isinstance(data, (bytes, bytearray)):
+                        data = data.encode(self.encoding)
+                    buf += data
+                    buf += self._trans_end_bytes
+                if buf:
+                    sender.write(buf)
+
+    def _read_select(self, fd, term, buf):
+        """
+        Reads a reply from the file descriptor of a device into buf,
+        waiting for data with a selector. Returns the buffer and the index
+        of the transaction end (-1 if not found).
+        """
+        idx = buf.find(term)
+        if idx != -1:
+            return buf, idx
+        received = False
+        deadline = time.monotonic() + self.timeout
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                if received and self.inter_byte_timeout is not None:
+                    wait = min(wait, self.inter_byte_timeout)
+                if not sel.select(wait):
+                    # Timeout, or a gap in the middle of the reply
+                    break
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    break
+                received = True
+                start = max(0, len(buf) - len(term) + 1)
+                buf += chunk
+                idx = buf.find(term, start)
+                if idx != -1:
+                    break
+        return buf, idx
+
+    def _read_serial(self, recvr, term, buf):
+        """
+        Reads a reply into buf using the read method of a device, for
+        devices without a file descriptor (e.g. on Windows), limiting each
+        read to the remaining time. Returns the buffer and the index of the
+        transaction end (-1 if not found).
+        """
+        idx = buf.find(term)
+        if idx != -1:
+            return buf, idx
+        received = False
+        deadline = time.monotonic() + self.timeout
+        timeout = recvr.timeout
+        try:
+            while True:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                # Only the driver setting makes a read return at a gap
+                gap_detect = (received
+                              and recvr.inter_byte_timeout is not None)
+                nr_bytes = recvr.in_waiting
+                if not nr_bytes:
+                    # Mid reply a larger read returns at the next gap
+                    nr_bytes = self.chunk_size if gap_detect else 1
+                recvr.timeout = wait
+                chunk = recvr.read(nr_bytes)
+                if not chunk:
+                    continue
+                received = True
+                start = max(0, len(buf) - len(term) + 1)
+                buf += chunk
+                idx = buf.find(term, start)
+                if idx != -1:
+                    break
+                if gap_detect and len(chunk) < nr_bytes:
+                    # Short read: inter byte timeout (or timeout) expired
+                    break
+        finally:
+            recvr.timeout = timeout
+        return buf, idx
+
+    def _fileno(self, device):
+        """
+        Returns the file descriptor of a device, or None if it has none
+        (e.g. on Windows)
+        """
+        try:
+            return device.fileno()
+        except (AttributeError, OSError, serial.serialutil.SerialException):
+            return None
+
+    def _read_exact_select(self, fd, nbytes, buf, deadline):
+        """
+        Reads from the file descriptor of a device into buf until it holds
+        nbytes or the deadline passes. Returns the buffer.
+        """
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while len(buf) < nbytes:
+                wait = deadline - time.monotonic()
+                if wait <= 0 or not sel.select(wait):
+                    break
+                chunk = os.read(fd, nbytes - len(buf))
+                if not chunk:
+                    break
+                buf += chunk
+        return buf
+
+    def _read_exact_serial(self, recvr, nbytes, buf, deadline):
+        """
+        Reads into buf using the read method of a device until it holds
+        nbytes or the deadline passes, limiting each read to the remaining
+        time. Returns the buffer.
+        """
+        timeout = recvr.timeout
+        try:
+            while len(buf) < nbytes:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                recvr.timeout = wait
+                buf += recvr.read(nbytes - len(buf))
+        finally:
+            recvr.timeout = timeout
+        return buf
+
+    def _recv(self, recvr):
+        """
+        Reads a reply from an already resolved and opened device.
+        Reads whatever is available in chunks until the transaction end is
+        found or the timeout expires. If inter_byte_timeout is set (for
+        devices with an unreliable transaction end), a gap of more than
+        inter_byte_timeout after part of the reply has arrived also ends it.
+        The transaction end is not included in the reply, anything
+        received after it is kept for the next reply.
+        """
+        reply = ''
+        try:
+            term = self._trans_end_bytes
+            buf = self._rx_pending.pop(recvr, bytearray())
+            fd = self._fileno(recvr)
+            if fd is not None:
+                buf, idx = self._read_select(fd, term, buf)
+            else:
+                buf, idx = self._read_serial(recvr, term, buf)
+            if idx == -1:
+                idx = len(buf)
+            elif idx + len(term) < len(buf):
+                self._rx_pending[recvr] = buf[idx + len(term):]
+            reply = str(memoryview(buf)[:idx], self.encoding)
+        except Exception as e:
+            print(e)
+        return reply
 
     def recv(self, device):
-        """Implementation of the receive functionality"""
+        """Implementation of the receive functionality (see _recv)"""
         reply = ''
         recvr = self._resolv_device(device)
         if recvr is not None:
             if recvr.is_open:
-                try:
-                    reply = recvr.read_until(
-                        expected=self.trans_end.encode(self.encoding),
-                    ).decode(self.encoding)
-                except Exception as e:
-                    print(e)
+                reply = self._recv(recvr)
         return reply
 
+    def recv_exact(self, device, nbytes):
+        """
+        Receives exactly nbytes (raw, not decoded) from a device, without
+        looking for the transaction end. Returns fewer bytes if the timeout
+        expires first.
+        """
+        buf = bytearray()
+        recvr = self._resolv_device(device)
+        if recvr is not None:
+            if recvr.is_open:
+                buf = self._rx_pending.pop(recvr, buf)
+                if len(buf) > nbytes:
+                    self._rx_pending[recvr] = buf[nbytes:]
+                    del buf[nbytes:]
+                deadline = time.monotonic() + self.timeout
+                fd = self._fileno(recvr)
+                if fd is not None:
+                    buf = self._read_exact_select(fd, nbytes, buf, deadline)
+                else:
+                    buf = self._read_exact_serial(
+                        recvr, nbytes, buf, deadline
+                    )
+        return bytes(buf)
+
     def cmd(self, device, cmd):
         """A send followed by a recv. Returns the result"""
-        self.send(device, cmd)
-        return self.recv(device)
+        reply = ''
+        dev = self._resolv_device(device)
+        if dev is not None:
+            if dev.is_open:
+                self._send(dev, cmd)
+                reply = self._recv(dev)
+        return reply
+
+    def cmd_all(self, cmd, limit=8):
+        """
+        (Synchronously) sends cmd to all open devices in parallel.
+        Returns a dictionary with the reply of each device.
+        """
+        return self._run(self._cmd_all(cmd, limit))
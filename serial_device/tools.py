@@ -4,9 +4,12 @@ from serial_device.serial_device import SerialDevice
 
 class SerialCmdLine(SerialDevice):
 
-    def __init__(self, id_prefix="", baudrate=115200):
+    def __init__(self, id_prefix="", baudrate=115200, expected_id=None):
         super().__init__(id_prefix, baudrate)
-        self.scan()
+        if expected_id is not None:
+            self.scan(first=True, expected_id=expected_id)
+        else:
+            self.scan()
 
     def _print_selection(self):
         print("Please select a device from the list:")
@@ -21,7 +24,7 @@ class SerialCmdLine(SerialDevice):
                 self.run(id)
             else:
                 print("Requested device not found!")
-                self._print_select()
+                self._print_selection()
         elif nr_devs == 0:
             print("No device found!")
         elif nr_devs == 1:
@@ -29,55 +32,98 @@ class SerialCmdLine(SerialDevice):
             self.run(next(iter(self.devices)))
         else:
             print("Found multiple device candidates!")
-            self._print_select()
+            self._print_selection()
+
+    def _bye(self, id, cmd, cmdsplit):
+        return False
+
+    def _load_cmd(self, id, cmd, cmdsplit):
+        if len(cmdsplit) >= 2:
+            self.load(id, cmdsplit[1])
+        else:
+            print('Please specify filename')
+        return True
+
+    def _default(self, id, cmd, cmdsplit):
+        print(self.cmd(id, cmd))
+        return True
 
     def run(self, id):
         print("Getting command line ready...")
         self.open(id)
+        prompt = f"{id}:$ "
+        dispatch = {
+            'bye': self._bye,
+            'load': self._load_cmd,
+        }
         again = True
         while again:
-            cmd = input(f"{id}:$ ")
+            cmd = input(prompt)
             cmdsplit = cmd.split()
-            if cmdsplit[0] == 'bye':
-                again = False
-            elif cmdsplit[0] == 'load':
-                if len(cmd) >= 2:
-                    self.load(id, cmdsplit[1])
-                else:
-                    print('Please specify filename')
-            else:
-                print(self.cmd(id, cmd))
+            if cmdsplit:
+                handler = dispatch.get(cmdsplit[0], self._default)
+                again = handler(id, cmd, cmdsplit)
         self.close(id)
 
+    async def _read_lines(self, infile, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, infile.readline)
+            if not line:
+                break
+            await queue.put(line.rstrip('\r\n'))
+        await queue.put(None)
+
     async def _load(self, id, filename):
         try:
             infile = open(filename, 'r')
         except IOError:
             print(f'Unable to open file {filename}')
         else:
-            for line in infile:
-                line = line.rstrip('\r\n')
-                if line.startswith('#'):
-                    print(line)
-                else:
-                    linesplit = line.split()
-                    nr_items = len(linesplit)
-                    if nr_items > 0:
-                        if linesplit[0] == 'pause':
-                            pkey = input(
-                                'Press Enter to continue (a+Enter to abort): '
-                            )
-                            if pkey == 'a':
-                                break
-                        elif linesplit[0] == 'delay' and nr_items > 1:
-                            try:
-                                await asyncio.sleep(float(linesplit[1]))
-                            except ValueError:
-                                pass
-                        else:
-                            print(line)
-                            self.flush(id)
-                            print(self.cmd(id, line))
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue(maxsize=16)
+            with infile:
+                reader = asyncio.ensure_future(
+                    self._read_lines(infile, queue)
+                )
+                try:
+                    await self._run_lines(id, queue, loop)
+                finally:
+                    reader.cancel()
+                    try:
+                        await reader
+                    except asyncio.CancelledError:
+                        pass
+
+    async def _run_lines(self, id, queue, loop):
+        while True:
+            line = await queue.get()
+            if line is None:
+                break
+            if line.startswith('#'):
+                print(line)
+            else:
+                linesplit = line.split()
+                nr_items = len(linesplit)
+                if nr_items > 0:
+                    if linesplit[0] == 'pause':
+                        pkey = await loop.run_in_executor(
+                            None, input,
+                            'Press Enter to continue (a+Enter to abort): '
+                        )
+                        if pkey == 'a':
+                            break
+                    elif linesplit[0] == 'delay' and nr_items > 1:
+                        try:
+                            await asyncio.sleep(float(linesplit[1]))
+                        except ValueError:
+                            pass
+                    else:
+                        print(line)
+                        self.flush(id)
+                        print(await loop.run_in_executor(
+                            None, self.cmd, id, line
+                        ))
 
     def load(self, id, filename):
-        return asyncio.run(self._load(id, filename))
+        return self._run(self._load(id, filename))